@@ -8,6 +8,7 @@ from datetime import datetime
 import re
 import json
 import logging
+import functools
 
 # Загружаем переменные из файла .env
 load_dotenv()
@@ -45,6 +46,11 @@ last_user_message = {}
 # Recent activity ids per chat to avoid duplicate forwards (keeps last 100 IDs)
 recent_activity_ids = defaultdict(lambda: deque(maxlen=100))
 
+# Shared HTTP session so Direct Line / Telegram calls reuse pooled keep-alive
+# connections instead of a new TCP+TLS handshake per request (polling hits
+# Direct Line every POLL_INTERVAL).
+http_session = requests.Session()
+
 # Simple SQLite DB to persist chat settings when Copilot confirms setup
 DB_PATH = os.path.join(os.path.dirname(__file__), 'chat_settings.db')
 
@@ -52,6 +58,72 @@ DB_PATH = os.path.join(os.path.dirname(__file__), 'chat_settings.db')
 # NOTE: db.py currently uses SQLite and will raise NotImplementedError
 # if DATABASE_URL is set. This centralizes DB access for easier future migration.
 
+# Regexes used when parsing Copilot setup confirmations. Compiled once at import
+# since parse_and_persist_setup runs for every bot activity forwarded to Telegram.
+# matches lines like 'ru: ...' or 'en: Hello' or 'ja: おはよう'
+SHORT_CODE_LINE_RE = re.compile(r'^[A-Za-z]{2,3}\s*:')
+NOW_WE_SPEAK_RE = re.compile(r'now we speak', re.IGNORECASE)
+SETUP_COMPLETE_RE = re.compile(r'setup is complete', re.IGNORECASE)
+HAS_LETTER_RE = re.compile(r'[A-Za-zА-Яа-я]')
+LANG_SPLIT_RE = re.compile(r',|\band\b')
+
+
+def extract_language_names_from_text(t):
+    """Try to extract a list of language names from a free text string.
+
+    Returns a list of cleaned names (may be empty).
+    """
+    if not t or not isinstance(t, str):
+        return []
+    return list(_extract_language_names(t))
+
+
+# Copilot repeats the same prompt/confirmation templates across chats, so the
+# parsed result is cached by text. Returns a tuple so cached values can't be mutated.
+@functools.lru_cache(maxsize=256)
+def _extract_language_names(t):
+    s = t.strip()
+    # Remove common trailing sentences
+    for sep in ['Send your message and', 'Send your message', '\n']:
+        if sep in s:
+            s = s.split(sep, 1)[0]
+    s = s.strip().strip('.,;: ')
+    if not s:
+        return ()
+
+    # Prefer comma or 'and' separated lists
+    if ',' in s or '\band\b' in s:
+        # typical input is "English, Russian, Japanese": plain split when no 'and' to handle
+        if 'and' not in s:
+            parts = s.split(',')
+        else:
+            parts = LANG_SPLIT_RE.split(s)
+    else:
+        # fallback: split by slash or semicolon
+        if '/' in s:
+            parts = s.split('/')
+        elif ';' in s:
+            parts = s.split(';')
+        else:
+            # last resort: split by spaces but only accept if looks like a short list
+            tokens = s.split()
+            # if there are multiple tokens and not a long sentence, treat each token as a language
+            if 1 < len(tokens) <= 6:
+                parts = tokens
+            else:
+                return ()
+
+    cleaned = [p.strip().strip('.,;: ') for p in parts if p and p.strip()]
+    valid = []
+    for n in cleaned:
+        ln = n.lower()
+        if any(x in ln for x in ['no ', 'none', 'nothing', 'not']):
+            continue
+        # require at least one alphabetic character (Latin or Cyrillic)
+        if HAS_LETTER_RE.search(n):
+            valid.append(n)
+    return tuple(valid)
+
 
 def parse_and_persist_setup(chat_id, text):
     """Try to extract language names from Copilot's setup confirmation and persist them.
@@ -66,15 +138,10 @@ def parse_and_persist_setup(chat_id, text):
         # avoid parsing these as language names. Common signs: multiple lines and
         # lines starting with short language codes followed by ':' or multiple ':' occurrences.
         try:
-            if '\n' in text or text.count(':') >= 1:
-                lines = [l.strip() for l in text.splitlines() if l.strip()]
-                short_code_line = False
-                for ln in lines:
-                    # matches patterns like 'ru: ...' or 'en: Hello' or 'ja: おはよう'
-                    if re.match(r'^[A-Za-z]{2,3}\s*:', ln):
-                        short_code_line = True
-                        break
-                if short_code_line and len(lines) >= 1:
+            # every short-code line contains ':', so texts without one skip the line scan;
+            # any() stops at the first match, which is usually the first line
+            if ':' in text:
+                if any(SHORT_CODE_LINE_RE.match(ln.strip()) for ln in text.splitlines()):
                     app.logger.info("Skipping parse: looks like translation block for chat %s: %s", chat_id, text[:120])
                     return False
         except Exception:
@@ -92,59 +159,14 @@ def parse_and_persist_setup(chat_id, text):
                 app.logger.info("Ignoring negative setup text for chat %s: %s", chat_id, text)
                 return False
 
-        def extract_language_names_from_text(t):
-            """Try to extract a list of language names from a free text string.
-
-            Returns a list of cleaned names (may be empty).
-            """
-            if not t or not isinstance(t, str):
-                return []
-            s = t.strip()
-            # Remove common trailing sentences
-            for sep in ['Send your message and', 'Send your message', '\n']:
-                if sep in s:
-                    s = s.split(sep, 1)[0]
-            s = s.strip().strip('.,;: ')
-            if not s:
-                return []
-
-            # Prefer comma or 'and' separated lists
-            if ',' in s or '\band\b' in s:
-                parts = re.split(r',|\band\b', s)
-            else:
-                # fallback: split by slash or semicolon
-                if '/' in s:
-                    parts = s.split('/')
-                elif ';' in s:
-                    parts = s.split(';')
-                else:
-                    # last resort: split by spaces but only accept if looks like a short list
-                    tokens = s.split()
-                    # if there are multiple tokens and not a long sentence, treat each token as a language
-                    if 1 < len(tokens) <= 6:
-                        parts = tokens
-                    else:
-                        return []
-
-            cleaned = [p.strip().strip('.,;: ') for p in parts if p and p.strip()]
-            valid = []
-            for n in cleaned:
-                ln = n.lower()
-                if any(x in ln for x in ['no ', 'none', 'nothing', 'not']):
-                    continue
-                # require at least one alphabetic character (Latin or Cyrillic)
-                if re.search(r'[A-Za-zА-Яа-я]', n):
-                    valid.append(n)
-            return valid
-
         # 1) Try to parse the canonical confirmation text: look for markers
         after = None
         if 'now we speak' in lowered:
             # case-insensitive split
-            parts = re.split(r'now we speak', text, flags=re.IGNORECASE)
+            parts = NOW_WE_SPEAK_RE.split(text)
             after = parts[1] if len(parts) > 1 else None
         elif 'setup is complete' in lowered:
-            parts = re.split(r'setup is complete', text, flags=re.IGNORECASE)
+            parts = SETUP_COMPLETE_RE.split(text)
             after = parts[1] if len(parts) > 1 else None
 
         names = []
@@ -202,9 +224,9 @@ def long_poll_for_activity(conv_id, token, user_from_id, start_watermark, chat_i
     """
     import time
     try:
-        t0 = time.time()
+        t0 = time.monotonic()
         nw = start_watermark
-        while time.time() - t0 < total_timeout:
+        while time.monotonic() - t0 < total_timeout:
             activities, new_nw = get_copilot_response(conv_id, token, nw, user_from_id=user_from_id)
             if activities:
                 # update watermark
@@ -244,7 +266,7 @@ def start_direct_line_conversation():
         'Authorization': f'Bearer {DIRECT_LINE_SECRET}',
     }
     # Создаём новый разговор (conversation) и получаем conversationId (+ возможно token)
-    response = requests.post(DIRECT_LINE_ENDPOINT, headers=headers, timeout=10)
+    response = http_session.post(DIRECT_LINE_ENDPOINT, headers=headers, timeout=10)
     app.logger.info("DirectLine create convo status=%s", response.status_code)
     if response.status_code in (200, 201):
         try:
@@ -283,7 +305,7 @@ def send_message_to_copilot(conversation_id, token, text, from_id="user"):
     "from": {"id": str(from_id)},
         "text": text
     }
-    response = requests.post(url, headers=headers, json=payload, timeout=10)
+    response = http_session.post(url, headers=headers, json=payload, timeout=10)
     # Direct Line may return 200 or 201 on activity post
     app.logger.info("DirectLine send activity status=%s convo=%s", response.status_code, conversation_id)
     if response.status_code in (200, 201):
@@ -304,7 +326,7 @@ def get_copilot_response(conversation_id, token, last_watermark, user_from_id="u
     headers = {
         'Authorization': f'Bearer {token}',
     }
-    response = requests.get(url, headers=headers, timeout=10)
+    response = http_session.get(url, headers=headers, timeout=10)
     app.logger.info("DirectLine get activities status=%s convo=%s watermark=%s", response.status_code, conversation_id, last_watermark)
     if response.status_code == 200:
         try:
@@ -355,7 +377,7 @@ def telegram_webhook():
                     last_user_message[chat_id] = user_message
                 except Exception:
                     pass
-                app.logger.info(f"[worker] Received message from {chat_id}: {user_message}")
+                app.logger.info("[worker] Received message from %s: %s", chat_id, user_message)
 
                 # Проверяем, есть ли уже активный диалог для этого чата
                 if chat_id not in conversations:
@@ -371,7 +393,7 @@ def telegram_webhook():
 
                 # 1. Отправляем сообщение пользователя в Copilot
                 import time
-                start_ts = time.time()
+                start_ts = time.monotonic()
 
                 # 1. Отправляем сообщение пользователя в Copilot
                 send_message_to_copilot(session['conv_id'], session['token'], user_message, from_id=session.get('from_id', str(chat_id)))
@@ -379,7 +401,7 @@ def telegram_webhook():
                 # 2. Let the user know we're processing (typing...) — non-blocking
                 try:
                     typing_url = f"https://api.telegram.org/bot{TELEGRAM_API_TOKEN}/sendChatAction"
-                    requests.post(typing_url, data={'chat_id': chat_id, 'action': 'typing'}, timeout=2)
+                    http_session.post(typing_url, data={'chat_id': chat_id, 'action': 'typing'}, timeout=2)
                 except Exception:
                     pass
 
@@ -412,13 +434,13 @@ def telegram_webhook():
                         bot_response = True
                         break
                     time.sleep(POLL_INTERVAL)
-                    elapsed = time.time() - start_ts
+                    elapsed = time.monotonic() - start_ts
 
                 # update stored watermark even if no response
-                conversations[chat_id]['watermark'] = new_watermark
+                session['watermark'] = new_watermark
 
-                duration = time.time() - start_ts
-                app.logger.info(f"Processed message for chat={chat_id} duration={duration:.2f}s found_response={bool(bot_response)}")
+                duration = time.monotonic() - start_ts
+                app.logger.info("Processed message for chat=%s duration=%.2fs found_response=%s", chat_id, duration, bool(bot_response))
 
                 # 4. Ответ(ы) уже были отправлены в Telegram выше when iterating activities.
                 # Avoid sending a boolean or duplicate message here (was sending 'True').
@@ -430,8 +452,8 @@ def telegram_webhook():
                         pass
                     # start a background long-poller to catch delayed bot replies (if not already polling)
                     try:
-                        if not conversations[chat_id].get('polling'):
-                            conversations[chat_id]['polling'] = True
+                        if not session.get('polling'):
+                            session['polling'] = True
                             import threading as _threading
                             lp = _threading.Thread(target=long_poll_for_activity, args=(session['conv_id'], session['token'], session.get('from_id', str(chat_id)), new_watermark, chat_id))
                             lp.daemon = True
@@ -484,7 +506,7 @@ def send_telegram_message(chat_id, text):
         return True
 
     try:
-        response = requests.post(TELEGRAM_URL, json=payload, timeout=5)
+        response = http_session.post(TELEGRAM_URL, json=payload, timeout=5)
     except Exception as e:
         app.logger.error("Exception when sending to Telegram for chat %s: %s", chat_id, e)
         print(f"[LOCAL FALLBACK due to exception] chat={chat_id} text={text}")